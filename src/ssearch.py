@@ -1,144 +1,410 @@
-import requests
+import asyncio
+import base64
+import contextlib
 import csv
 import argparse
+import email.utils
+import httpx
 import urllib.parse
-import json
+import orjson
 import os
-from tqdm import tqdm
+import queue
+import sqlite3
+import sys
+import time
+from datetime import datetime, timezone
+from tqdm.asyncio import tqdm
 
 BASE_URL = "https://api.ultradns.com"
+MAX_CONCURRENCY = 32  # Sub-accounts listed at once
+MAX_CONNECTIONS = 64  # Connection cap; HTTP/2 multiplexes over far fewer
+MAX_IN_FLIGHT = 128  # Requests outstanding at once, whatever the connection count; also the zone worker count
+PAGE_SIZE = 1000  # Largest page the listing endpoints return
+SUBACCOUNTS_URL = f"{BASE_URL}/subaccounts?limit={PAGE_SIZE}&offset={{offset}}"
+SUBACCOUNT_TOKEN_URL = f"{BASE_URL}/subaccounts/{{account}}/token"
+ZONES_URL = f"{BASE_URL}/v2/zones"
+POOLS_URL = f"{BASE_URL}/v2/zones/{{zone}}/rrsets?q=kind:POOLS&limit={PAGE_SIZE}&offset={{offset}}"
+# Zone and pool listings compress well; httpx decodes br when Brotli is installed
+SESSION_HEADERS = {"Accept-Encoding": "gzip, deflate, br"}
+RETRY_TOTAL = 5
+RETRY_BACKOFF = 0.5  # Seconds; doubles per attempt unless the API sends Retry-After
+RETRY_STATUSES = {429, 502, 503, 504}
+OUTPUT_BUFFER_SIZE = 1 << 20  # Coalesce row writes into large file writes
+ROW_QUEUE_SIZE = 10000  # Rows waiting for the writer thread before scanning pauses
+FIELDS = ("Sub Account Name", "Zone Name", "Pool Name", "Pool Type")
+TOKEN_REFRESH_LEEWAY = 60  # Seconds before expiry that a token is renewed
 
-def get_primary_token(username=None, password=None, token=None):
+requests_in_flight = None  # Created in main() so it belongs to the running event loop
+
+class ResponseCache:
+    # On-disk copy of listing pages keyed by sub-account and URL, sent back to
+    # the API as If-None-Match/If-Modified-Since so unchanged pages come back
+    # as an empty 304. Disabled until open() is called.
+    def __init__(self):
+        self.db = None
+
+    def open(self, path):
+        self.db = sqlite3.connect(os.path.expanduser(path))
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses (scope TEXT, url TEXT, etag TEXT, last_modified TEXT, body BLOB, PRIMARY KEY (scope, url))")
+
+    def close(self):
+        if self.db:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+    def get(self, scope, url):
+        if not self.db:
+            return None
+        return self.db.execute("SELECT etag, last_modified, body FROM responses WHERE scope = ? AND url = ?", (scope, url)).fetchone()
+
+    def put(self, scope, url, etag, last_modified, body):
+        self.db.execute("REPLACE INTO responses VALUES (?, ?, ?, ?, ?)", (scope, url, etag, last_modified, body))
+
+response_cache = ResponseCache()
+
+def retry_delay(response, attempt):
+    # Wait as long as a 429/503 Retry-After asks (in seconds or as an HTTP
+    # date), otherwise back off exponentially.
+    retry_after = response.headers.get("Retry-After") if response is not None and response.status_code in (429, 503) else None
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0.0, (email.utils.parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+    return RETRY_BACKOFF * 2 ** attempt
+
+async def fetch(client, method, url, **kwargs):
+    # Every request goes through the one pooled client so connections are
+    # reused; transient failures are retried. The in-flight slot is given up
+    # while waiting to retry so backoff doesn't starve other requests.
+    for attempt in range(RETRY_TOTAL + 1):
+        async with requests_in_flight:
+            try:
+                response = await client.request(method, url, **kwargs)
+            except httpx.TransportError:
+                if attempt == RETRY_TOTAL:
+                    raise
+                response = None
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt == RETRY_TOTAL:
+                    return response
+        await asyncio.sleep(retry_delay(response, attempt))
+
+async def get_listing(client, url, token, cache_scope, params=None, missing_ok=False):
+    # Fetch and parse one listing page, revalidating a cached copy if there is
+    # one and serving it when the API answers 304. With missing_ok, a 404
+    # returns None instead of raising.
+    cache_url = str(httpx.URL(url, params=params)) if params and response_cache.db else url
+    cached = response_cache.get(cache_scope, cache_url)
+    validators = {}
+    if cached:
+        if cached[0]:
+            validators["If-None-Match"] = cached[0]
+        if cached[1]:
+            validators["If-Modified-Since"] = cached[1]
+    response = await make_request(client, "get", url, token, extra_headers=validators, params=params)
+    if cached and response.status_code == 304:
+        return orjson.loads(cached[2])
+    if missing_ok and response.status_code == 404:
+        return None
+    response.raise_for_status()
+    etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+    if response_cache.db and response.status_code == 200 and (etag or last_modified):
+        response_cache.put(cache_scope, cache_url, etag, last_modified, response.content)
+    return read_json(response)
+
+def decode_token_expiry(token):
+    # Read the "exp" claim from a JWT without verifying it; None if the token
+    # isn't a JWT or carries no numeric expiry.
+    try:
+        payload = token.split(".")[1]
+        exp = orjson.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))["exp"]
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+    return exp if isinstance(exp, (int, float)) else None
+
+class TokenHolder:
+    # Hands out an access token, renewing it shortly before it expires rather
+    # than waiting for a request to bounce with a 401. Expiry comes from the
+    # JWT "exp" claim, or failing that the expiresIn the token was issued
+    # with. `renew` is a coroutine function returning a fresh
+    # (token, expires_in) pair, or None if it can't be renewed.
+    def __init__(self, token, expires_in=None, renew=None):
+        self.renew = renew
+        self.lock = asyncio.Lock()
+        self.set(token, expires_in)
+
+    def set(self, token, expires_in=None):
+        # Headers are built once per token and shared by every request using it
+        self.token = token
+        self.headers = {"Authorization": f"Bearer {token}"}
+        exp = decode_token_expiry(token)
+        if exp is not None:
+            lifetime = exp - time.time()
+        else:
+            try:
+                lifetime = float(expires_in)
+            except (TypeError, ValueError):
+                lifetime = None
+        # Short-lived tokens are renewed halfway through rather than immediately
+        self.refresh_at = None if lifetime is None else time.monotonic() + lifetime - min(TOKEN_REFRESH_LEEWAY, lifetime / 2)
+
+    async def get(self):
+        if self.renew and self.refresh_at is not None and time.monotonic() >= self.refresh_at:
+            await self.refresh(self.token)
+        return self.token
+
+    async def refresh(self, stale_token):
+        # Concurrent callers holding the same stale token share one renewal
+        async with self.lock:
+            if self.renew and self.token == stale_token:
+                renewed = await self.renew()
+                if renewed:
+                    self.set(*renewed)
+                else:
+                    self.refresh_at = None  # Keep the current token rather than retrying on every call
+
+async def auth_headers(token):
+    await token.get()
+    return token.headers
+
+def read_json(response):
+    return orjson.loads(response.content)
+
+async def get_primary_token(client, username=None, password=None, token=None):
     if token:
-        print("Warning: A masquerade token cannot be refreshed upon expiry.")
-        return token, None
+        print("Warning: A masquerade token cannot be refreshed upon expiry.", file=sys.stderr)
+        return token, None, None
     auth_endpoint = f"{BASE_URL}/authorization/token"
     auth_data = {
         "grant_type": "password",
         "username": username,
         "password": password
     }
-    response = requests.post(auth_endpoint, data=auth_data, headers={"Content-Type": "application/x-www-form-urlencoded"})
+    response = await fetch(client, "post", auth_endpoint, data=auth_data, headers={"Content-Type": "application/x-www-form-urlencoded"})
     response.raise_for_status()
-    return response.json().get("accessToken"), response.json().get("refreshToken")
+    data = read_json(response)
+    return data.get("accessToken"), data.get("refreshToken"), data.get("expiresIn")
 
-def refresh_token(refresh_token):
+async def refresh_token(client, refresh_token):
     auth_endpoint = f"{BASE_URL}/authorization/token"
     auth_data = {
         "grant_type": "refresh_token",
         "refresh_token": refresh_token
     }
-    response = requests.post(auth_endpoint, data=auth_data, headers={"Content-Type": "application/x-www-form-urlencoded"})
+    response = await fetch(client, "post", auth_endpoint, data=auth_data, headers={"Content-Type": "application/x-www-form-urlencoded"})
     response.raise_for_status()
-    return response.json().get("accessToken")
-
-def make_request(method, url, token, refresh_token, **kwargs):
-    headers = {"Authorization": f"Bearer {token}"}
-    response = requests.request(method, url, headers=headers, **kwargs)
-    if response.status_code == 403:
-        return response  # Return the response to handle the error at the caller level
-    if response.status_code == 401 and refresh_token:
-        new_token = refresh_token(refresh_token)
-        headers["Authorization"] = f"Bearer {new_token}"
-        response = requests.request(method, url, headers=headers, **kwargs)
+    data = read_json(response)
+    return data.get("accessToken"), data.get("expiresIn")
+
+async def make_request(client, method, url, token, extra_headers=None, **kwargs):
+    # Sends a request with the token's Authorization header. A 401 means the
+    # token was revoked or expired earlier than announced, so it is renewed and
+    # the request retried once.
+    for retried in (False, True):
+        headers = await auth_headers(token)
+        stale_token = token.token
+        response = await fetch(client, method, url, headers={**headers, **extra_headers} if extra_headers else headers, **kwargs)
+        if response.status_code != 401 or retried or not token.renew:
+            return response
+        await token.refresh(stale_token)
+
+def remaining_offsets(data):
+    # The first page of an offset-paginated listing reports the total count,
+    # so every further page can be requested at once.
+    return range(PAGE_SIZE, data["resultInfo"]["totalCount"], PAGE_SIZE)
+
+async def get_subaccounts_page(client, token, offset):
+    response = await make_request(client, "get", SUBACCOUNTS_URL.format(offset=offset), token)
+    if response.status_code == 403 and 'do not have permissions' in response.text:
+        print("Error: You do not have permissions to access sub-accounts. Ensure you're using a reseller account.", file=sys.stderr)
+        exit(1)
     response.raise_for_status()
-    return response
+    return read_json(response)
 
-def get_subaccounts(token, refresh_token, offset=0):
-    subaccounts = []
-    while True:
-        response = make_request("get", f"{BASE_URL}/subaccounts?limit=1000&offset={offset}", token, refresh_token)
-        if response.status_code == 403 and 'do not have permissions' in response.text:
-            print("Error: You do not have permissions to access sub-accounts. Ensure you're using a reseller account.")
-            exit(1)
-        response.raise_for_status()
-        data = response.json()
-        subaccounts.extend(data.get("accounts", []))
-        if data["resultInfo"]["returnedCount"] < 1000:
-            break
-        offset += 1000
-    return subaccounts
+async def iter_subaccounts(client, token):
+    data = await get_subaccounts_page(client, token, 0)
+    for account in data.get("accounts", []):
+        yield account
+    pages = await asyncio.gather(*(get_subaccounts_page(client, token, offset) for offset in remaining_offsets(data)))
+    for page in pages:
+        for account in page.get("accounts", []):
+            yield account
 
-def get_subaccount_token(account_name, primary_token):
-    headers = {
-        "Authorization": f"Bearer {primary_token}",
-        "Content-Type": "application/json"
-    }
+async def mint_subaccount_token(client, account_name, primary_token):
+    response = await make_request(client, "post", SUBACCOUNT_TOKEN_URL.format(account=urllib.parse.quote(account_name, safe='')), primary_token, extra_headers={"Content-Type": "application/json"})
     try:
-        response = requests.post(f"{BASE_URL}/subaccounts/{account_name.replace(' ', '%20')}/token", headers=headers)
         response.raise_for_status()
-        return response.json()["accessToken"]
-    except requests.HTTPError as e:
+    except httpx.HTTPStatusError:
         if 'is suspended' in response.text:
-            print(f"Skipping suspended sub-account: {account_name}")
+            print(f"Skipping suspended sub-account: {account_name}", file=sys.stderr)
             return None
         else:
             raise
+    data = read_json(response)
+    return data["accessToken"], data.get("expiresIn")
+
+async def get_subaccount_token(client, account_name, primary_token):
+    # The sub-account's token, wrapped so it is re-minted as it nears expiry
+    minted = await mint_subaccount_token(client, account_name, primary_token)
+    if not minted:
+        return None
+    return TokenHolder(*minted, renew=lambda: mint_subaccount_token(client, account_name, primary_token))
 
-def get_zones(token, cursor=""):
-    headers = {"Authorization": f"Bearer {token}"}
-    zones = []
+async def iter_zones(client, account_name, token, cursor=""):
+    params = {"limit": PAGE_SIZE, "cursor": cursor}
     while True:
-        response = requests.get(f"{BASE_URL}/v2/zones?limit=1000&cursor={cursor}", headers=headers)
-        response.raise_for_status()
-        data = response.json()
-        zones.extend(data.get("zones", []))
-        cursor = data["cursorInfo"].get("next")
-        if not cursor:
+        data = await get_listing(client, ZONES_URL, token, account_name, params=params)
+        for zone in data.get("zones", []):
+            yield zone
+        params["cursor"] = data["cursorInfo"].get("next")
+        if not params["cursor"]:
             break
-    return zones
 
-def get_pools(zone_name, token, offset=0):
-    headers = {"Authorization": f"Bearer {token}"}
-    pools = []
+async def get_pools_page(client, account_name, quoted_zone, token, offset):
+    return await get_listing(client, POOLS_URL.format(zone=quoted_zone, offset=offset), token, account_name, missing_ok=True)
+
+async def iter_pools(client, account_name, quoted_zone, token):
+    data = await get_pools_page(client, account_name, quoted_zone, token, 0)
+    if data is None:
+        return
+    for pool in data.get("rrSets", []):
+        yield pool
+    pages = await asyncio.gather(*(get_pools_page(client, account_name, quoted_zone, token, offset) for offset in remaining_offsets(data)))
+    for page in pages:
+        for pool in page.get("rrSets", []) if page else ():
+            yield pool
+
+async def scan_zone(client, rows, account_name, zone_name, token):
+    quoted_zone = urllib.parse.quote(zone_name, safe='')
+    async for pool in iter_pools(client, account_name, quoted_zone, token):
+        pool_name = pool["ownerName"]
+        pool_type = pool["profile"]["@context"]
+        await put_row(rows, (account_name, zone_name, pool_name, pool_type))
+
+async def process_account(client, zones, account, primary_token):
+    account_name = account.get("accountName")
+    subaccount_token = await get_subaccount_token(client, account_name, primary_token)
+    if not subaccount_token:
+        return
+    # Blocks while the zone queue is full, so listing never runs far ahead of scanning
+    async for zone in iter_zones(client, account_name, subaccount_token):
+        await zones.put((account_name, zone["properties"]["name"], subaccount_token))
+
+async def work(queue, handle, progress):
+    while (item := await queue.get()) is not None:
+        await handle(*item)
+        progress.update()
+
+class CsvWriter:
+    # csv.writer with a fast path: DNS names and pool types rarely need
+    # quoting, so rows without special characters are joined directly.
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.writer = csv.writer(outfile)
+
+    def writerow(self, row):
+        if any(ch in value for value in row for ch in ',"\r\n'):
+            self.writer.writerow(row)
+        else:
+            self.outfile.write(",".join(row) + "\r\n")
+
+class JsonArrayWriter:
+    # Streams row tuples out as an indented JSON array of objects, one element
+    # at a time, with the same writerow() interface as csv.writer.
+    def __init__(self, outfile, fields):
+        self.outfile = outfile
+        self.fields = fields
+        self.separator = "[\n"
+
+    def writerow(self, row):
+        self.outfile.write(self.separator + "  " + orjson.dumps(dict(zip(self.fields, row)), option=orjson.OPT_INDENT_2).decode().replace("\n", "\n  "))
+        self.separator = ",\n"
+
+    def close(self):
+        self.outfile.write("[]\n" if self.separator == "[\n" else "\n]\n")
+
+def write_rows(writer, rows):
+    # Runs on a worker thread so a slow output file or pipe never stalls the
+    # event loop; None marks the end of the scan.
+    while (row := rows.get()) is not None:
+        writer.writerow(row)
+
+async def put_row(rows, row):
+    # The row queue is bounded so a slow output pauses the scan instead of
+    # buffering it; wait for room without blocking the event loop.
     while True:
-        response = requests.get(f"{BASE_URL}/v2/zones/{urllib.parse.quote(zone_name)}/rrsets?q=kind:POOLS&limit=1000&offset={offset}", headers=headers)
-        if response.status_code == 404:
-            break
-        response.raise_for_status()
-        data = response.json()
-        pools.extend(data.get("rrSets", []))
-        if data["resultInfo"]["returnedCount"] < 1000:
-            break
-        offset += 1000
-    return pools
+        try:
+            return rows.put_nowait(row)
+        except queue.Full:
+            await asyncio.sleep(0.01)
 
-def main(username=None, password=None, token=None, output_file=None, format="json"):
-    primary_token, refresh_token_val = get_primary_token(username, password, token)
-    subaccounts = get_subaccounts(primary_token, refresh_token_val)
-    data = [{"Sub Account Name": "", "Zone Name": "", "Pool Name": "", "Pool Type": ""}]
-    
-    for account in tqdm(subaccounts, desc="Processing sub-accounts"):
-        account_name = account.get("accountName")
-        subaccount_token = get_subaccount_token(account_name, primary_token)
-        if not subaccount_token:
-            continue
-        zones = get_zones(subaccount_token)
-        for zone in tqdm(zones, desc="Processing zones for " + account_name, leave=False):
-            zone_name = zone["properties"]["name"]
-            pools = get_pools(zone_name, subaccount_token)
-            for pool in pools:
-                pool_name = pool["ownerName"]
-                pool_type = pool["profile"]["@context"]
-                data.append({"Sub Account Name": account_name, "Zone Name": zone_name, "Pool Name": pool_name, "Pool Type": pool_type})
+def stop_writing(rows):
+    # The scan failed: drop unwritten rows so the writer thread sees the end
+    # marker straight away and exits.
+    with contextlib.suppress(queue.Empty):
+        while True:
+            rows.get_nowait()
+    rows.put_nowait(None)
 
+def open_output(output_file):
     if output_file:
-        with open(os.path.expanduser(output_file), 'w') as outfile:
-            if format == "json":
-                json.dump(data, outfile, indent=4)
-            elif format == "csv":
-                csvwriter = csv.DictWriter(outfile, fieldnames=data[0].keys())
-                csvwriter.writeheader()
-                for row in data[1:]:
-                    csvwriter.writerow(row)
-    else:
+        return open(os.path.expanduser(output_file), 'w', newline='', encoding='utf-8', buffering=OUTPUT_BUFFER_SIZE)
+    return contextlib.nullcontext(sys.stdout)
+
+async def main(username=None, password=None, token=None, output_file=None, format="json", cache_file=None):
+    global requests_in_flight
+    requests_in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+    if cache_file:
+        response_cache.open(cache_file)
+    with open_output(output_file) as outfile:
+        if format == "csv":
+            writer = CsvWriter(outfile)
+            writer.writerow(FIELDS)
+        else:
+            writer = JsonArrayWriter(outfile, FIELDS)
+
+        rows = queue.Queue(maxsize=ROW_QUEUE_SIZE)
+        try:
+            async with httpx.AsyncClient(http2=True, limits=httpx.Limits(max_connections=MAX_CONNECTIONS), headers=SESSION_HEADERS, timeout=httpx.Timeout(30, pool=None)) as client:
+                primary_token, refresh_token_val, expires_in = await get_primary_token(client, username, password, token)
+                renew = (lambda: refresh_token(client, refresh_token_val)) if refresh_token_val else None
+                primary_token = TokenHolder(primary_token, expires_in, renew)
+                # Fixed pools of workers drain bounded queues, so memory stays flat
+                # however many sub-accounts and zones there are. If any worker, or
+                # the writer thread, fails the task groups cancel the rest.
+                accounts = asyncio.Queue(maxsize=MAX_CONCURRENCY)
+                zones = asyncio.Queue(maxsize=MAX_IN_FLIGHT)
+                with tqdm(desc="Processing sub-accounts", total=0) as account_progress, tqdm(desc="Processing zones", leave=False, mininterval=0.5, disable=not sys.stderr.isatty()) as zone_progress:
+                    async with asyncio.TaskGroup() as output:
+                        output.create_task(asyncio.to_thread(write_rows, writer, rows))
+                        try:
+                            async with asyncio.TaskGroup() as scanning:
+                                for _ in range(MAX_IN_FLIGHT):
+                                    scanning.create_task(work(zones, lambda *zone: scan_zone(client, rows, *zone), zone_progress))
+                                async with asyncio.TaskGroup() as listing:
+                                    for _ in range(MAX_CONCURRENCY):
+                                        listing.create_task(work(accounts, lambda account: process_account(client, zones, account, primary_token), account_progress))
+                                    async for account in iter_subaccounts(client, primary_token):
+                                        account_progress.total += 1
+                                        await accounts.put((account,))
+                                    for _ in range(MAX_CONCURRENCY):
+                                        await accounts.put(None)
+                                for _ in range(MAX_IN_FLIGHT):
+                                    await zones.put(None)
+                        except BaseException:
+                            stop_writing(rows)
+                            raise
+                        await put_row(rows, None)
+        finally:
+            response_cache.close()
+
         if format == "json":
-            print(json.dumps(data, indent=4))
-        elif format == "csv":
-            csvwriter = csv.DictWriter(sys.stdout, fieldnames=data[0].keys())
-            csvwriter.writeheader()
-            for row in data[1:]:
-                csvwriter.writerow(row)
+            writer.close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="UltraDNS Subaccounts Zones and Pools Finder")
@@ -150,6 +416,7 @@ if __name__ == "__main__":
     auth_group.add_argument("--password", help="Password for authentication")
     
     parser.add_argument("--output-file", help="Output file name. If not provided, prints to terminal.")
+    parser.add_argument("--cache-file", help="SQLite file for caching zone and pool listings between runs. Unchanged pages are revalidated instead of downloaded again.")
     parser.add_argument("--format", choices=["json", "csv"], default="json", help="Output format: 'json' or 'csv'. Default is 'json'.")
     
     args = parser.parse_args()
@@ -157,4 +424,4 @@ if __name__ == "__main__":
     if args.token is None and (args.username is None or args.password is None):
         parser.error("When token is not provided, both username and password are required")
     
-    main(username=args.username, password=args.password, token=args.token, output_file=args.output_file, format=args.format)
+    asyncio.run(main(username=args.username, password=args.password, token=args.token, output_file=args.output_file, format=args.format, cache_file=args.cache_file))